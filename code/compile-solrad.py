@@ -1,28 +1,157 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
 import xarray as xr
 import glob
 import os
 import re
 import warnings
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+
+try:
+    import h5netcdf  # noqa: F401
+    HAS_H5NETCDF = True
+except ImportError:
+    HAS_H5NETCDF = False
+
+try:
+    import hdf5plugin
+    HAS_BLOSC = HAS_H5NETCDF
+except ImportError:
+    HAS_BLOSC = False
 
 # Suppress warnings for cleaner output, can be removed for debugging
 warnings.filterwarnings('ignore', category=FutureWarning)
 
+# Timestamp format written by aggregate_to_10min in get-cams-solrad-ts.py.
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+NS_PER_HOUR = 3600 * 1_000_000_000
+
+# Mantissa bits kept when bit-rounding irradiance (of 23 in float32), about 0.05% relative precision.
+KEEP_MANTISSA_BITS = 10
+
+# Translation table that deletes every ASCII character other than letters, digits and whitespace.
+_STRIP_SPECIAL = str.maketrans('', '', ''.join(
+    c for c in map(chr, range(128)) if not (c.isalnum() or c.isspace())
+))
+
+@lru_cache(maxsize=256)
 def clean_station_name(name):
     """
     A robust function to clean and standardize station names for reliable matching.
     It replaces underscores, removes special characters, converts to lowercase,
     and standardizes spacing.
     """
-    # Replace underscores with spaces first
-    cleaned_name = name.replace('_', ' ')
-    # Keep only letters, numbers, and spaces, then convert to lowercase
-    cleaned_name = re.sub(r'[^a-zA-Z0-9\s]', '', cleaned_name).lower()
+    # Replace underscores and any (Unicode) whitespace with single spaces first
+    cleaned_name = ' '.join(name.replace('_', ' ').split())
+    # Keep only letters, numbers, and spaces (non-ASCII is dropped), then convert to lowercase
+    cleaned_name = cleaned_name.encode('ascii', 'ignore').decode('ascii').translate(_STRIP_SPECIAL).lower()
     # Replace multiple spaces with a single space
-    cleaned_name = re.sub(r'\s+', ' ', cleaned_name).strip()
-    return cleaned_name
+    return ' '.join(cleaned_name.split())
+
+def _process_one(filepath, locations_dict, exclude_key):
+    """
+    Reads a single processed station CSV file and prepares it for compilation.
+
+    This runs in a worker process, so it only relies on picklable arguments.
+
+    Args:
+        filepath (str): Path to the station data CSV file.
+        locations_dict (dict): Station metadata keyed by the cleaned station key.
+        exclude_key (str or None): Cleaned key of a station to exclude.
+
+    Returns:
+        pa.Table or None: The station's data, or None if the file was skipped.
+    """
+    try:
+        filename = os.path.basename(filepath)
+        # Use a regular expression to robustly extract the station name part from the filename.
+        match = re.search(r'processed_10min_(.*?)_observed_cloud\.csv', filename)
+        if not match:
+            print(f"  - Could not extract station name from '{filename}'. Skipping.")
+            return None
+
+        # Get the raw name part from the filename.
+        station_name_from_file = match.group(1)
+        # Create a cleaned key from the filename for matching.
+        station_key = clean_station_name(station_name_from_file)
+
+        # Skip the specified station (using the cleaned key for comparison).
+        if exclude_key and station_key == exclude_key:
+            print(f"  - Excluding station: {station_name_from_file.replace('_', ' ')}")
+            return None
+
+        # Check if the cleaned key exists in the location data.
+        if station_key not in locations_dict:
+            print(f"  - Warning: No location info for '{station_name_from_file.replace('_', ' ')}'. Skipping file.")
+            return None
+
+        # If it exists, retrieve the station's data.
+        station_info = locations_dict[station_key]
+        # Get the original, properly-cased station name for use in the output file.
+        original_station_name = station_info['station_original']
+
+        # Read the required columns from the CSV with the multi-threaded Arrow parser.
+        # Irradiance is kept as float32, which is ample precision for W/m^2 values.
+        df = pv.read_csv(
+            filepath,
+            read_options=pv.ReadOptions(use_threads=True),
+            convert_options=pv.ConvertOptions(
+                include_columns=['time', 'GHI', 'DHI', 'BNI'],
+                column_types={'time': pa.string(), 'GHI': pa.float32(), 'DHI': pa.float32(), 'BNI': pa.float32()}
+            )
+        ).to_pandas(self_destruct=True)
+        if df.empty:
+            print(f"  - Warning: File '{filename}' is empty. Skipping.")
+            return None
+
+        # Rename BNI column to DNI.
+        df.rename(columns={'BNI': 'DNI'}, inplace=True)
+
+        # --- CORRECTED Time Conversion ---
+        utc_offset = station_info['utc_offset']
+        # Treat the source 'time' column as UTC, parsed with the known fixed format.
+        df['time_utc'] = pd.to_datetime(df['time'], format=TIME_FORMAT, cache=True, errors='coerce')
+        df.dropna(subset=['time_utc'], inplace=True)
+        # Calculate local time by ADDING the offset to UTC time, as a plain int64 nanosecond add.
+        utc_ns = df['time_utc'].to_numpy(dtype='datetime64[ns]').view('i8')
+        df['time_local'] = (utc_ns + int(utc_offset) * NS_PER_HOUR).view('datetime64[ns]')
 
-def compile_solar_data_to_netcdf(location_file, file_pattern, output_file, exclude_station=None):
+        # Add the original, properly-cased station name to the DataFrame for later indexing.
+        df['station'] = original_station_name
+
+        print(f"  + Successfully processed: {original_station_name}")
+        return pa.Table.from_pandas(df[['station', 'time_utc', 'time_local', 'GHI', 'DHI', 'DNI']], preserve_index=False)
+
+    except Exception as e:
+        print(f"  - Error processing file '{filepath}': {e}")
+        return None
+
+def _bit_round(values, keep_bits):
+    """
+    Rounds float32 values in place to the nearest value with only `keep_bits` mantissa bits.
+
+    The zeroed trailing mantissa bits make the data far more compressible. Non-finite
+    values (NaN, inf) are left untouched.
+
+    Args:
+        values (np.ndarray): A float32 array, modified in place.
+        keep_bits (int): Number of mantissa bits to keep (0 to 23).
+    """
+    drop_bits = 23 - keep_bits
+    if drop_bits <= 0:
+        return
+    bits = values.view(np.uint32)
+    finite = np.isfinite(values)
+    # Round half to even on the last kept bit, then clear the dropped bits.
+    half = np.uint32((1 << (drop_bits - 1)) - 1)
+    rounded = bits + half + ((bits >> np.uint32(drop_bits)) & np.uint32(1))
+    rounded &= np.uint32(~((1 << drop_bits) - 1) & 0xFFFFFFFF)
+    bits[finite] = rounded[finite]
+
+def compile_solar_data_to_netcdf(location_file, file_pattern, output_file, exclude_station=None, use_blosc=False):
     """
     Compiles multiple CSV files of solar radiation data into a single NetCDF file.
 
@@ -38,6 +167,9 @@ def compile_solar_data_to_netcdf(location_file, file_pattern, output_file, exclu
         file_pattern (str): Glob pattern to find the data CSV files (e.g., 'processed_*_cloud.csv').
         output_file (str): Path for the output NetCDF file.
         exclude_station (str, optional): Case-insensitive name of a station to exclude.
+        use_blosc (bool, optional): Compress with Blosc/zstd instead of zlib. The file can then
+            only be read where the HDF5 Blosc filter is available (e.g. after importing hdf5plugin),
+            so this is off by default. Requires h5netcdf and hdf5plugin.
     """
     # --- 1. Read and Prepare Station Location Data ---
     try:
@@ -67,79 +199,51 @@ def compile_solar_data_to_netcdf(location_file, file_pattern, output_file, exclu
         return
 
     # --- 3. Process Each File and Collect Data ---
-    all_data_list = []
+    # A plain dict keyed by 'station_key' is cheap to pickle for the worker processes.
+    locations_dict = locations_df.to_dict('index')
+    exclude_key = clean_station_name(exclude_station) if exclude_station else None
+
     print("Starting to process station files...")
-    for filepath in all_files:
-        try:
-            filename = os.path.basename(filepath)
-            # Use a regular expression to robustly extract the station name part from the filename.
-            match = re.search(r'processed_10min_(.*?)_observed_cloud\.csv', filename)
-            if not match:
-                print(f"  - Could not extract station name from '{filename}'. Skipping.")
-                continue
-            
-            # Get the raw name part from the filename.
-            station_name_from_file = match.group(1)
-            # Create a cleaned key from the filename for matching.
-            station_key = clean_station_name(station_name_from_file)
-
-            # Skip the specified station (using the cleaned key for comparison).
-            if exclude_station and station_key == clean_station_name(exclude_station):
-                print(f"  - Excluding station: {station_name_from_file.replace('_', ' ')}")
-                continue
-
-            # Check if the cleaned key exists in the location data index.
-            if station_key not in locations_df.index:
-                print(f"  - Warning: No location info for '{station_name_from_file.replace('_', ' ')}' in '{location_file}'. Skipping file.")
-                continue
-
-            # If it exists, retrieve the station's data.
-            station_info = locations_df.loc[station_key]
-            # Get the original, properly-cased station name for use in the output file.
-            original_station_name = station_info['station_original']
-
-            # Read the required columns from the CSV.
-            df = pd.read_csv(filepath, usecols=['time', 'GHI', 'DHI', 'BNI'])
-            if df.empty:
-                print(f"  - Warning: File '{filename}' is empty. Skipping.")
-                continue
-
-            # Rename BNI column to DNI.
-            df.rename(columns={'BNI': 'DNI'}, inplace=True)
-            
-            # --- CORRECTED Time Conversion ---
-            utc_offset = station_info['utc_offset']
-            # Treat the source 'time' column as UTC.
-            df['time_utc'] = pd.to_datetime(df['time'], errors='coerce')
-            # Calculate local time by ADDING the offset to UTC time.
-            df['time_local'] = df['time_utc'] + pd.to_timedelta(utc_offset, unit='h')
-            
-            df.dropna(subset=['time_utc', 'time_local'], inplace=True)
-            
-            # Add the original, properly-cased station name to the DataFrame for later indexing.
-            df['station'] = original_station_name
-            
-            all_data_list.append(df[['station', 'time_utc', 'time_local', 'GHI', 'DHI', 'DNI']])
-            print(f"  + Successfully processed: {original_station_name}")
-
-        except Exception as e:
-            print(f"  - Error processing file '{filepath}': {e}")
-
-    if not all_data_list:
+    worker = partial(_process_one, locations_dict=locations_dict, exclude_key=exclude_key)
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        results = executor.map(worker, all_files, chunksize=4)
+        all_tables = [table for table in results if table is not None]
+
+    if not all_tables:
         print("\nNo data was successfully processed. Aborting NetCDF file creation.")
         return
 
     # --- 4. Combine Data and Create xarray Dataset ---
     print("\nCombining data from all stations...")
-    combined_df = pd.concat(all_data_list, ignore_index=True)
-    combined_df.set_index(['station', 'time_utc'], inplace=True)
+    table = pa.concat_tables(all_tables)
 
     print("Creating xarray Dataset...")
-    ds = combined_df.to_xarray()
+    # Build the (station, time) grid directly instead of unstacking a MultiIndex frame,
+    # which would first materialize the full dense frame in pandas.
+    # A single factorization per key gives both the sorted coordinates and each row's position.
+    station_cats = pd.Categorical(table['station'].to_numpy())
+    time_cats = pd.Categorical(table['time_utc'].to_numpy())
+    unique_stations = station_cats.categories.to_numpy()
+    unique_times = time_cats.categories.to_numpy()
+    station_idx, time_idx = station_cats.codes, time_cats.codes
+    grid_shape = (len(unique_stations), len(unique_times))
+
+    data_vars = {}
+    for var in ['time_local', 'GHI', 'DHI', 'DNI']:
+        values = table[var].to_numpy()
+        fill_value = np.datetime64('NaT') if var == 'time_local' else np.nan
+        grid = np.full(grid_shape, fill_value, dtype=values.dtype)
+        grid[station_idx, time_idx] = values
+        data_vars[var] = (('station', 'time'), grid)
+
+    ds = xr.Dataset(data_vars, coords={'station': unique_stations, 'time': unique_times})
+
+    # Bit-round the irradiance so the zlib/Blosc filters compress it much better.
+    for var in ['GHI', 'DHI', 'DNI']:
+        _bit_round(ds[var].values, KEEP_MANTISSA_BITS)
 
     # --- 5. Assign Coordinates and Attributes ---
     # We need to get the coordinates for the unique, original station names.
-    unique_stations = ds.station.values
     station_keys_for_coords = [clean_station_name(s) for s in unique_stations]
     station_coords = locations_df.loc[station_keys_for_coords]
 
@@ -149,16 +253,17 @@ def compile_solar_data_to_netcdf(location_file, file_pattern, output_file, exclu
         'elevation': ('station', station_coords['elevation'].values)
     })
 
-    # Rename the 'time_utc' dimension to just 'time' for convention.
-    ds = ds.rename({'time_utc': 'time'})
-
     # Add descriptive attributes to the file and variables.
     ds.attrs = {
         'title': 'Compiled Solar Radiation Data from CAMS ECMWF',
         'institution': 'BMKG for WETSA Project',
         'source': f'Compiled from CSV files matching "{file_pattern}"',
         'history': f'Created on {pd.Timestamp.now(tz="utc").isoformat()} using a Python script.',
-        'comment': 'Data includes GHI, DHI, and DNI for multiple stations in Indonesia.'
+        'comment': (
+            'Data includes GHI, DHI, and DNI for multiple stations in Indonesia. '
+            f'GHI, DHI, and DNI are bit-rounded to {KEEP_MANTISSA_BITS} mantissa bits '
+            f'(relative precision about {2.0 ** -(KEEP_MANTISSA_BITS + 1):.2%}) to improve compression.'
+        )
     }
 
     # Variable-specific attributes
@@ -175,18 +280,43 @@ def compile_solar_data_to_netcdf(location_file, file_pattern, output_file, exclu
     # --- 6. Save to NetCDF ---
     try:
         # This ensures both time variables use the same units and calendar.
-        encoding_options = {
-            'time': {
-                'units': 'seconds since 1970-01-01 00:00:00',
-                'calendar': 'proleptic_gregorian'
-            },
-            'time_local': {
-                'units': 'seconds since 1970-01-01 00:00:00',
-                'calendar': 'proleptic_gregorian'
-            }
+        time_encoding = {
+            'units': 'seconds since 1970-01-01 00:00:00',
+            'calendar': 'proleptic_gregorian'
         }
-        print(f"\nSaving data to '{output_file}'...")
-        ds.to_netcdf(output_file, format='NETCDF4', engine='netcdf4', encoding=encoding_options)
+        encoding_options = {'time': dict(time_encoding)}
+
+        # Store each (station, time) variable as a single chunk, so it goes through HDF5 as
+        # one contiguous write. The time axis is only split if a chunk would exceed 2 GiB
+        # (HDF5 caps chunks at 4 GiB).
+        n_stations, n_times = ds.sizes['station'], ds.sizes['time']
+        chunksizes = (n_stations, max(1, min(n_times, (2 << 30) // (8 * n_stations))))
+        # zlib (deflate) is readable by any NetCDF4/HDF5 reader; Blosc is opt-in.
+        if use_blosc and not HAS_BLOSC:
+            print("Warning: Blosc compression requires h5netcdf and hdf5plugin. Falling back to zlib.")
+        if use_blosc and HAS_BLOSC:
+            # h5netcdf can use the Blosc filters registered by hdf5plugin.
+            compression = dict(hdf5plugin.Blosc(cname='zstd', clevel=1, shuffle=hdf5plugin.Blosc.SHUFFLE))
+            ds.attrs['compression'] = (
+                'GHI, DHI, DNI and time_local use the Blosc/zstd HDF5 filter (id 32001) with shuffle; '
+                'reading requires the filter plugin, e.g. `import hdf5plugin`.'
+            )
+        else:
+            compression = {'zlib': True, 'complevel': 1, 'shuffle': True}
+            ds.attrs['compression'] = 'GHI, DHI, DNI and time_local use zlib (deflate) level 1 with shuffle.'
+        # h5netcdf writes through h5py, which is faster than netcdf4-python's serial path.
+        engine = 'h5netcdf' if HAS_H5NETCDF else 'netcdf4'
+        engine_kwargs = {'invalid_netcdf': False} if engine == 'h5netcdf' else {}
+
+        for var in ['GHI', 'DHI', 'DNI', 'time_local']:
+            var_encoding = dict(time_encoding) if var == 'time_local' else {}
+            var_encoding.update(compression)
+            var_encoding['chunksizes'] = chunksizes
+            var_encoding['dtype'] = 'i8' if var == 'time_local' else 'float32'
+            encoding_options[var] = var_encoding
+
+        print(f"\nSaving data to '{output_file}' (engine: {engine})...")
+        ds.to_netcdf(output_file, format='NETCDF4', engine=engine, encoding=encoding_options, **engine_kwargs)
         print("\n--- Success! ---")
         print(f"NetCDF file created at: {output_file}")
         print("\nDataset Summary:")
@@ -205,12 +335,15 @@ if __name__ == '__main__':
     OUTPUT_FILE = 'compiled_solar_data.nc'
     # Name of the station to exclude from the compilation
     EXCLUDE_STATION = 'Sleman'
+    # Compress with Blosc/zstd instead of zlib (readers then need the HDF5 Blosc filter, e.g. hdf5plugin)
+    USE_BLOSC = False
 
     # --- Run the main function ---
     compile_solar_data_to_netcdf(
         location_file=LOCATION_FILE,
         file_pattern=FILE_PATTERN,
         output_file=OUTPUT_FILE,
-        exclude_station=EXCLUDE_STATION
+        exclude_station=EXCLUDE_STATION,
+        use_blosc=USE_BLOSC
     )
 
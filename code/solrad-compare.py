@@ -2,10 +2,108 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
-from scipy import stats
 import os
 
-def analyze_and_plot_solar_data(ground_filepath, cams_filepath, location_name, output_filename):
+try:
+    import datashader as ds
+    from datashader.mpl_ext import dsshow
+    HAS_DATASHADER = True
+except ImportError:
+    HAS_DATASHADER = False
+
+# Below this many points, the comparison scatter is drawn point by point with matplotlib.
+DATASHADER_MIN_POINTS = 5000
+# Raster bins per device pixel for datashader; 1/12 makes each bin about the size of the
+# old s=10 scatter marker at dpi=300, instead of one barely visible device pixel per point.
+DATASHADER_PIXEL_SCALE = 1 / 12
+
+# Irradiance in W/m^2 never needs more than float32 precision, which halves memory traffic.
+RADIATION_DTYPES = {'GHI': 'float32', 'DHI': 'float32', 'DNI': 'float32', 'BNI': 'float32'}
+
+# QC flag columns of the ground data; a row is kept only when all of its flags are zero.
+# They are read as float32 because flag cells may be blank; blank flags count as unset.
+FLAG_COLS = [
+    'flag_ghi', 'flag_dhi', 'flag_dni', 'flag_ghi_rare',
+    'flag_dhi_rare', 'flag_dni_rare', 'flag_comp1', 'flag_comp2'
+]
+
+def _read_cached(csv_path, dtype=None):
+    """
+    Reads a CSV file through a Parquet cache stored next to it.
+
+    The cache ('<csv_path>.parquet') is used when it is newer than the CSV file;
+    otherwise the CSV is parsed and the cache is (re)written for the next run.
+
+    Args:
+        csv_path (str): Path to the CSV file.
+        dtype (dict, optional): Column dtypes, applied to both the CSV and the cached data.
+
+    Returns:
+        pd.DataFrame: The parsed data.
+    """
+    cache_path = csv_path + '.parquet'
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(csv_path):
+        df = pd.read_parquet(cache_path, engine='pyarrow')
+        if dtype:
+            df = df.astype({col: col_type for col, col_type in dtype.items() if col in df.columns})
+        return df
+
+    df = pd.read_csv(csv_path, dtype=dtype)
+    try:
+        df.to_parquet(cache_path, compression='zstd', engine='pyarrow')
+    except Exception as e:
+        print(f"Warning: Could not write Parquet cache {cache_path}: {e}")
+    return df
+
+def _emptiest_corner(x, y, limit, box_width=0.45, box_height=0.25):
+    """
+    Picks the off-diagonal corner of a square comparison panel that covers the fewest points.
+
+    Used to place the legend on rasterized panels, where loc='best' cannot see the data.
+    Only 'upper left' and 'lower right' are considered, since the fit and 1:1 lines run
+    through the other two corners.
+
+    Args:
+        x (pd.Series): Values on the x axis.
+        y (pd.Series): Values on the y axis.
+        limit (float): Upper limit of both axes (the lower limit is 0).
+        box_width (float, optional): Legend box width as a fraction of the axis.
+        box_height (float, optional): Legend box height as a fraction of the axis.
+
+    Returns:
+        str: A matplotlib legend location.
+    """
+    x_frac = x.to_numpy() / limit
+    y_frac = y.to_numpy() / limit
+    upper_left = np.count_nonzero((x_frac <= box_width) & (y_frac >= 1 - box_height))
+    lower_right = np.count_nonzero((x_frac >= 1 - box_width) & (y_frac <= box_height))
+    return 'upper left' if upper_left <= lower_right else 'lower right'
+
+def _linear_fits(x, y):
+    """
+    Computes ordinary least-squares fits y = slope * x + intercept column by column.
+
+    Args:
+        x (np.ndarray): Array of shape (n, k) with the predictors.
+        y (np.ndarray): Array of shape (n, k) with the responses.
+
+    Returns:
+        tuple: Arrays of length k with the slopes, intercepts, and correlation coefficients.
+    """
+    x_mean = x.mean(axis=0)
+    y_mean = y.mean(axis=0)
+    dx = x - x_mean
+    dy = y - y_mean
+    cov_xy = np.einsum('ij,ij->j', dx, dy)
+    var_x = np.einsum('ij,ij->j', dx, dx)
+    var_y = np.einsum('ij,ij->j', dy, dy)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = cov_xy / var_x
+        r_value = cov_xy / np.sqrt(var_x * var_y)
+    intercept = y_mean - slope * x_mean
+    return slope, intercept, r_value
+
+def analyze_and_plot_solar_data(ground_filepath, cams_filepath, location_name, output_filename, fig=None):
     """
     Main function to load, process, and visualize solar radiation data,
     with explicit UTC timezone handling and unit correction.
@@ -15,11 +113,14 @@ def analyze_and_plot_solar_data(ground_filepath, cams_filepath, location_name, o
         cams_filepath (str): Path to the CAMS model data CSV file.
         location_name (str): The name of the location for the plot title.
         output_filename (str): Filename for the output PNG plot.
+        fig (matplotlib.figure.Figure, optional): Figure to clear and draw into, so one
+            figure can be reused across locations. A new figure is created (and closed
+            after saving) if not given.
     """
 
     # --- 1. Load and Clean Ground-Based Data (W/m^2) ---
     try:
-        ground_df = pd.read_csv(ground_filepath)
+        ground_df = _read_cached(ground_filepath, dtype={**RADIATION_DTYPES, **{col: 'float32' for col in FLAG_COLS}})
         dt_series = pd.to_datetime(ground_df['Datetime (UTC)'])
         if dt_series.dt.tz is None:
             ground_df['timestamp'] = dt_series.dt.tz_localize('UTC')
@@ -32,20 +133,18 @@ def analyze_and_plot_solar_data(ground_filepath, cams_filepath, location_name, o
         print(f"An error occurred while reading the ground data file: {e}")
         return
 
-    flag_cols = [
-        'flag_ghi', 'flag_dhi', 'flag_dni', 'flag_ghi_rare',
-        'flag_dhi_rare', 'flag_dni_rare', 'flag_comp1', 'flag_comp2'
-    ]
-    existing_flag_cols = [col for col in flag_cols if col in ground_df.columns]
+    existing_flag_cols = [col for col in FLAG_COLS if col in ground_df.columns]
     initial_rows = len(ground_df)
-    cleaned_ground_df = ground_df[ground_df[existing_flag_cols].sum(axis=1) == 0].copy()
-    print(f"Ground data: Loaded {initial_rows} rows, {len(cleaned_ground_df)} rows remain after QC filtering.")
-    cleaned_ground_df.rename(columns={'GHI': 'GHI_ground', 'DHI': 'DHI_ground', 'DNI': 'DNI_ground'}, inplace=True)
-    ground_final_df = cleaned_ground_df[['GHI_ground', 'DHI_ground', 'DNI_ground']]
+    flags = ground_df[existing_flag_cols].fillna(0).to_numpy(dtype=np.int8)
+    keep = ~flags.any(axis=1)
+    ground_final_df = ground_df.loc[keep, ['GHI', 'DHI', 'DNI']].rename(
+        columns={'GHI': 'GHI_ground', 'DHI': 'DHI_ground', 'DNI': 'DNI_ground'}
+    )
+    print(f"Ground data: Loaded {initial_rows} rows, {len(ground_final_df)} rows remain after QC filtering.")
 
     # --- 2. Load CAMS Model Data (Wh/m^2) ---
     try:
-        cams_df = pd.read_csv(cams_filepath)
+        cams_df = _read_cached(cams_filepath, dtype=RADIATION_DTYPES)
         dt_series_cams = pd.to_datetime(cams_df['time'])
         if dt_series_cams.dt.tz is None:
             cams_df['timestamp'] = dt_series_cams.dt.tz_localize('UTC')
@@ -77,7 +176,15 @@ def analyze_and_plot_solar_data(ground_filepath, cams_filepath, location_name, o
     cams_final_df = cams_df[cams_cols_to_select]
 
     # --- 3. Merge and Analyze ---
-    merged_df = pd.merge(ground_final_df, cams_final_df, left_index=True, right_index=True, how='inner')
+    # Inner join on the timestamps: intersect the int64 index values and gather both sides by position.
+    # Both indexes are brought to the same unit first, since CSV parsing and Parquet caches may differ.
+    _, ground_pos, cams_pos = np.intersect1d(
+        ground_final_df.index.as_unit('ns').asi8, cams_final_df.index.as_unit('ns').asi8, return_indices=True
+    )
+    merged_df = pd.concat([
+        ground_final_df.iloc[ground_pos],
+        cams_final_df.iloc[cams_pos].set_axis(ground_final_df.index[ground_pos])
+    ], axis=1)
     merged_df.dropna(inplace=True)
     print(f"Merged data: Found {len(merged_df)} common data points for comparison after filtering.")
 
@@ -93,7 +200,13 @@ def analyze_and_plot_solar_data(ground_filepath, cams_filepath, location_name, o
 
     # --- 4. Create Visualization ---
     num_rows = 4 if has_cloud_data else 3
-    fig = plt.figure(figsize=(22, 5 * num_rows))
+    if fig is None:
+        fig = plt.figure(figsize=(22, 5 * num_rows))
+        close_fig = True
+    else:
+        fig.clf()
+        fig.set_size_inches(22, 5 * num_rows)
+        close_fig = False
     # The plot title is now dynamic based on the location_name parameter.
     fig.suptitle(f'Comparison of CAMS Model vs. Ground Measurements in {location_name} (2024)', fontsize=16)
 
@@ -103,6 +216,12 @@ def analyze_and_plot_solar_data(ground_filepath, cams_filepath, location_name, o
     colors = ['royalblue', 'darkorange', 'seagreen']
     vmax = 500
 
+    # Fit all three components at once; merged_df has already been cleaned of NaN rows.
+    slopes, intercepts, r_values = _linear_fits(
+        merged_df[[f'{comp}_ground' for comp in components]].to_numpy(dtype=np.float64),
+        merged_df[[f'{comp}_cams' for comp in components]].to_numpy(dtype=np.float64)
+    )
+
     for i, comp in enumerate(components):
         inner_gs = gridspec.GridSpecFromSubplotSpec(1, 2, subplot_spec=outer_gs[i], wspace=0.2, width_ratios=[3, 2])
 
@@ -121,21 +240,26 @@ def analyze_and_plot_solar_data(ground_filepath, cams_filepath, location_name, o
         x_data = merged_df[f'{comp}_ground']
         y_data = merged_df[f'{comp}_cams']
         abs_bias = abs(merged_df[f'{comp}_bias'])
+        max_val = max(x_data.max(), y_data.max())
 
-        # Filter out NaN or infinite values before linear regression
-        valid_data = pd.concat([x_data, y_data], axis=1).dropna()
-        if valid_data.empty:
-            print(f"Skipping regression for {comp} due to lack of valid data.")
-            continue
-            
-        slope, intercept, r_value, p_value, std_err = stats.linregress(valid_data[f'{comp}_ground'], valid_data[f'{comp}_cams'])
-        r_squared = r_value**2
-
-        sc = scatter_ax.scatter(x_data, y_data, c=abs_bias, cmap='viridis', s=10, alpha=0.7, vmin=0, vmax=vmax)
+        slope, intercept = slopes[i], intercepts[i]
+        r_squared = r_values[i]**2
+
+        use_datashader = HAS_DATASHADER and len(merged_df) >= DATASHADER_MIN_POINTS
+        if use_datashader:
+            # Rasterize large point clouds, colouring each pixel by the mean absolute bias.
+            sc = dsshow(
+                pd.DataFrame({'x': x_data, 'y': y_data, 'abs_bias': abs_bias}),
+                ds.Point('x', 'y'), ds.mean('abs_bias'),
+                ax=scatter_ax, cmap='viridis', vmin=0, vmax=vmax,
+                x_range=(0, max_val * 1.05), y_range=(0, max_val * 1.05),
+                width_scale=DATASHADER_PIXEL_SCALE, height_scale=DATASHADER_PIXEL_SCALE
+            )
+        else:
+            sc = scatter_ax.scatter(x_data, y_data, c=abs_bias, cmap='viridis', s=10, alpha=0.7, vmin=0, vmax=vmax)
         cbar = fig.colorbar(sc, ax=scatter_ax)
         cbar.set_label('Absolute Bias [W/m²]')
 
-        max_val = max(x_data.max(), y_data.max())
         line_x = np.array([0, max_val])
         line_y = slope * line_x + intercept
         scatter_ax.plot(line_x, line_y, 'r-', linewidth=2, label=f'Fit: y={slope:.2f}x + {intercept:.1f}\nR²={r_squared:.3f}')
@@ -144,7 +268,11 @@ def analyze_and_plot_solar_data(ground_filepath, cams_filepath, location_name, o
         scatter_ax.set_xlabel(f'Measured {comp} (Ground) [W/m²]')
         scatter_ax.set_ylabel(f'Calculated {comp} (CAMS) [W/m²]')
         scatter_ax.set_title(f'{comp} Comparison (n={len(merged_df)})')
-        scatter_ax.legend()
+        if use_datashader:
+            # loc='best' does not see the datashader image, so check the corners against the data.
+            scatter_ax.legend(loc=_emptiest_corner(x_data, y_data, max_val * 1.05))
+        else:
+            scatter_ax.legend()
         scatter_ax.grid(True, linestyle=':', alpha=0.5)
         scatter_ax.set_aspect('equal', adjustable='box')
         scatter_ax.set_xlim(0, max_val * 1.05)
@@ -182,12 +310,13 @@ def analyze_and_plot_solar_data(ground_filepath, cams_filepath, location_name, o
         ax_ratio.grid(True, linestyle=':', alpha=0.7)
         ax_ratio.set_ylim(bottom=0)
 
-    plt.tight_layout(rect=[0, 0, 1, 0.96])
+    fig.tight_layout(rect=[0, 0, 1, 0.96])
 
     # --- 5. Save and Close Plot ---
-    plt.savefig(output_filename, dpi=300)
+    fig.savefig(output_filename, dpi=300)
     print(f"\nPlot successfully saved to {output_filename}")
-    plt.close(fig) # Close the figure to free up memory
+    if close_fig:
+        plt.close(fig) # Close the figure to free up memory
 
 
 if __name__ == '__main__':
@@ -202,6 +331,9 @@ if __name__ == '__main__':
         'Ternate'
     ]
 
+    # A single figure is cleared and reused for every location's plot.
+    fig = plt.figure(figsize=(22, 20))
+
     # Loop through each location to generate a plot.
     for location in locations:
         print(f"--- Processing data for {location.replace('_', ' ')} ---")
@@ -224,9 +356,10 @@ if __name__ == '__main__':
 
         # Call the main function with the dynamic file paths and names
         try:
-            analyze_and_plot_solar_data(ground_file, cams_file, location_title_name, output_file)
+            analyze_and_plot_solar_data(ground_file, cams_file, location_title_name, output_file, fig=fig)
         except Exception as e:
             print(f"An unexpected error occurred while processing {location}: {e}")
 
+    plt.close(fig)
     print("\n--- All locations processed. ---")
 